@@ -7,6 +7,7 @@
 import logging
 import numpy as np
 import torch
+import torchvision
 from .util import BaseTransform
 from distutils.version import LooseVersion
 
@@ -15,7 +16,7 @@ try:
 except ModuleNotFoundError:
     pd = None
 
-__all__ = ['GetBoundingBoxes', 'GetMultiScaleBoundingBoxes', 'NonMaxSuppression', 'NonMaxSupression', 'TensorToBrambox', 'ReverseLetterbox']
+__all__ = ['GetBoundingBoxes', 'GetMultiScaleBoundingBoxes', 'NonMaxSuppression', 'NonMaxSuppressionFast', 'NonMaxSupression', 'TensorToBrambox', 'ReverseLetterbox']
 log = logging.getLogger(__name__)
 
 torchversion = LooseVersion(torch.__version__)
@@ -42,7 +43,10 @@ class GetBoundingBoxes(BaseTransform):
         self.anchors = torch.Tensor(anchors)
         self.num_anchors = self.anchors.shape[0]
         self.anchors_step = self.anchors.shape[1]
+        self._grid_cache = {}
+        self._anchor_cache = {}
 
+    @torch.no_grad()
     def __call__(self, network_output):
         # Check dimensions
         if network_output.dim() == 3:
@@ -55,45 +59,93 @@ class GetBoundingBoxes(BaseTransform):
         w = network_output.size(3)
 
         # Compute xc,yc, w,h, box_score on Tensor
-        lin_x = torch.linspace(0, w-1, w).repeat(h, 1).view(h*w).to(device)
-        lin_y = torch.linspace(0, h-1, h).view(h, 1).repeat(1, w).view(h*w).to(device)
-        anchor_w = self.anchors[:, 0].contiguous().view(1, self.num_anchors, 1).to(device)
-        anchor_h = self.anchors[:, 1].contiguous().view(1, self.num_anchors, 1).to(device)
+        lin_x, lin_y = self._get_grid(h, w, device)
+        anchor_w, anchor_h = self._get_anchors(device)
 
         network_output = network_output.view(batch, self.num_anchors, -1, h*w)  # -1 == 5+num_classes (we can drop feature maps if 1 class)
-        network_output[:, :, 0, :].sigmoid_().add_(lin_x).div_(w)               # X center
-        network_output[:, :, 1, :].sigmoid_().add_(lin_y).div_(h)               # Y center
-        network_output[:, :, 2, :].exp_().mul_(anchor_w).div_(w)                # Width
-        network_output[:, :, 3, :].exp_().mul_(anchor_h).div_(h)                # Height
-        network_output[:, :, 4, :].sigmoid_()                                   # Box score
+        coords, box_score = _decode(network_output, lin_x, lin_y, anchor_w, anchor_h, w, h)
 
-        # Compute class_score
+        # Mask select boxes > conf_thresh (box score is an upper bound for the confidence, so we can already filter on it)
+        score_thresh = box_score > self.conf_thresh
+        if score_thresh.sum() == 0:
+            return torch.tensor([]).to(device)
+
+        coords = coords[score_thresh]
+        scores = box_score[score_thresh]
+        batch_num = torch.arange(batch, dtype=torch.float, device=device).view(batch, 1, 1).expand_as(score_thresh)[score_thresh]
+
+        # Compute class_score (only for the remaining boxes)
         if self.num_classes > 1:
-            with torch.no_grad():
-                cls_scores = torch.nn.functional.softmax(network_output[:, :, 5:, :], 2)
-            cls_max, cls_max_idx = torch.max(cls_scores, 2)
-            cls_max_idx = cls_max_idx.float()
-            cls_max.mul_(network_output[:, :, 4, :])
+            scores, idx = _class_scores(scores, network_output[:, :, 5:, :].transpose(2, 3)[score_thresh])
+            idx = idx.float()
+
+            # Mask select boxes > conf_thresh
+            score_thresh = scores > self.conf_thresh
+            if score_thresh.sum() == 0:
+                return torch.tensor([]).to(device)
+
+            coords = coords[score_thresh]
+            scores = scores[score_thresh]
+            idx = idx[score_thresh]
+            batch_num = batch_num[score_thresh]
         else:
-            cls_max = network_output[:, :, 4, :]
-            cls_max_idx = torch.zeros_like(cls_max)
+            idx = torch.zeros_like(scores)
 
-        score_thresh = cls_max > self.conf_thresh
-        if score_thresh.sum() == 0:
-            return torch.tensor([]).to(device)
+        return torch.cat([batch_num[:, None], coords, scores[:, None], idx[:, None]], dim=1)
+
+    def _get_grid(self, h, w, device):
+        """ Get the x and y offsets of each cell in the output grid.
+        These are only computed once for every combination of (h, w, device) and get reused afterwards.
+        """
+        key = (h, w, device)
+        if key not in self._grid_cache:
+            lin_x = torch.arange(w, dtype=torch.float, device=device).repeat(h)
+            lin_y = torch.arange(h, dtype=torch.float, device=device).view(h, 1).repeat(1, w).view(h*w)
+            self._grid_cache[key] = (lin_x, lin_y)
+
+        return self._grid_cache[key]
+
+    def _get_anchors(self, device):
+        """ Get the width and height of the anchors on a device.
+        These are only copied once to every device and get reused afterwards.
+        """
+        if device not in self._anchor_cache:
+            anchor_w = self.anchors[:, 0].contiguous().view(1, self.num_anchors, 1).to(device)
+            anchor_h = self.anchors[:, 1].contiguous().view(1, self.num_anchors, 1).to(device)
+            self._anchor_cache[device] = (anchor_w, anchor_h)
 
-        # Mask select boxes > conf_thresh
-        coords = network_output.transpose(2, 3)[..., 0:4]
-        coords = coords[score_thresh[..., None].expand_as(coords)].view(-1, 4)
-        scores = cls_max[score_thresh]
-        idx = cls_max_idx[score_thresh]
+        return self._anchor_cache[device]
 
-        # Get batch numbers of the detections
-        batch_num = score_thresh.view(batch, -1)
-        nums = torch.arange(1, batch+1, dtype=torch.uint8, device=batch_num.device)
-        batch_num = (batch_num * nums[:, None])[batch_num] - 1
 
-        return torch.cat([batch_num[:, None].float(), coords, scores[:, None], idx[:, None]], dim=1)
+@torch.jit.script
+def _decode(network_output, lin_x, lin_y, anchor_w, anchor_h, w, h):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor, int, int) -> Tuple[Tensor, Tensor]
+    """ Decode the raw network output to relative box coordinates and box scores.
+    This is written as a single scripted function, so that the JIT fuser can compute all values in one pass over the data.
+
+    Returns:
+        tuple: coordinates [batch, anchors, h*w, 4] and box scores [batch, anchors, h*w]
+    """
+    x = (network_output[:, :, 0, :].sigmoid() + lin_x) / w          # X center
+    y = (network_output[:, :, 1, :].sigmoid() + lin_y) / h          # Y center
+    bw = network_output[:, :, 2, :].exp() * anchor_w / w            # Width
+    bh = network_output[:, :, 3, :].exp() * anchor_h / h            # Height
+    box_score = network_output[:, :, 4, :].sigmoid()                # Box score
+
+    return torch.stack([x, y, bw, bh], 3), box_score
+
+
+@torch.jit.script
+def _class_scores(box_score, class_output):
+    # type: (Tensor, Tensor) -> Tuple[Tensor, Tensor]
+    """ Combine the box scores with the highest class probabilities.
+    This is written as a single scripted function, so that the JIT fuser can combine the softmax, max and multiplication.
+
+    Returns:
+        tuple: confidence scores [boxes] and class indices [boxes]
+    """
+    cls_max, cls_max_idx = torch.softmax(class_output, 1).max(1)
+    return box_score * cls_max, cls_max_idx
 
 
 class GetMultiScaleBoundingBoxes(GetBoundingBoxes):
@@ -122,12 +174,14 @@ class GetMultiScaleBoundingBoxes(GetBoundingBoxes):
     def __init__(self, num_classes, anchors, conf_thresh):
         super().__init__(num_classes, anchors[0], conf_thresh)
         self.root_anchors = torch.tensor(anchors, requires_grad=False)
+        self._root_anchor_cache = [{} for _ in anchors]
 
     def __call__(self, network_output):
         boxes = []
         for i, output in enumerate(network_output):
             self.anchors = self.root_anchors[i]
             self.num_anchors = self.anchors.shape[0]
+            self._anchor_cache = self._root_anchor_cache[i]
             boxes.append(super().__call__(output))
         return torch.cat(boxes)
 
@@ -145,11 +199,68 @@ class NonMaxSuppression(BaseTransform):
     Note:
         This post-processing function expects the input to be bounding boxes,
         like the ones created by :class:`lightnet.data.GetBoundingBoxes` and outputs exactly the same format.
+
+    Note:
+        The actual suppression is performed by :func:`torchvision.ops.batched_nms`,
+        which runs the nms of all images (and classes) with one call to its compiled C++/CUDA implementation.
     """
     def __init__(self, nms_thresh, class_nms=True):
         self.nms_thresh = nms_thresh
         self.class_nms = class_nms
 
+    @torch.no_grad()
+    def __call__(self, boxes):
+        if boxes.numel() == 0:
+            return boxes
+
+        a = boxes[:, 1:3]
+        b = boxes[:, 3:5]
+        bboxes = torch.cat([a-b/2, a+b/2], 1)
+        scores = boxes[:, 5]
+
+        # Boxes can only suppress boxes from the same group (image and optionally class)
+        if self.class_nms:
+            groups = boxes[:, 0] * (boxes[:, 6].max() + 1) + boxes[:, 6]
+        else:
+            groups = boxes[:, 0]
+
+        keep = torchvision.ops.batched_nms(bboxes, scores, groups.long(), self.nms_thresh)
+        keep, _ = keep.sort()
+        return boxes[keep]
+
+
+class NonMaxSuppressionFast(NonMaxSuppression):
+    """ Performs a faster version of nms on the bounding boxes, filtering boxes with a high overlap.
+
+    Args:
+        nms_thresh (Number [0-1]): Overlapping threshold to filter detections with non-maxima suppresion
+        class_nms (Boolean, optional): Whether to perform nms per class; Default **True**
+        half (Boolean, optional): Whether to compute the IOU matrix in half precision, which halves its memory traffic; Default **False**
+        top_k (int, optional): Only consider the ``top_k`` highest scoring boxes of each image, discarding the others; Default **None**
+
+    Returns:
+        (Tensor [Boxes x 7]]): **[batch_num, x_center, y_center, width, height, confidence, class_id]** for every bounding box
+
+    Note:
+        This post-processing function expects the input to be bounding boxes,
+        like the ones created by :class:`lightnet.data.GetBoundingBoxes` and outputs exactly the same format.
+
+    Warning:
+        This is a vectorized implementation of the Fast NMS algorithm from YOLACT :cite:`yolact`. |br|
+        It is not entirely equivalent to :class:`~lightnet.data.transform.NonMaxSuppression`,
+        as boxes that were already removed can still suppress other boxes.
+        This means it might remove slightly more boxes, but it does not need any sequential loop and thus runs entirely on the device of the boxes.
+
+    Note:
+        The ``half`` argument only has an effect on CUDA tensors, as half precision is slow on the CPU. |br|
+        The IOU values of small boxes lose precision in half precision, which might lead to slightly different results around the ``nms_thresh``.
+    """
+    def __init__(self, nms_thresh, class_nms=True, half=False, top_k=None):
+        super().__init__(nms_thresh, class_nms)
+        self.half = half
+        self.top_k = top_k
+
+    @torch.no_grad()
     def __call__(self, boxes):
         if boxes.numel() == 0:
             return boxes
@@ -172,44 +283,61 @@ class NonMaxSuppression(BaseTransform):
         a = boxes[:, 1:3]
         b = boxes[:, 3:5]
         bboxes = torch.cat([a-b/2, a+b/2], 1)
+        areas = b.prod(1)
         scores = boxes[:, 5]
         classes = boxes[:, 6]
 
-        # Sort coordinates by descending score
-        scores, order = scores.sort(0, descending=True)
-        x1, y1, x2, y2 = bboxes[order].split(1, 1)
+        # Sort coordinates by descending score (only the top_k boxes)
+        if self.top_k is None or self.top_k > scores.shape[0]:
+            k = scores.shape[0]
+        else:
+            k = self.top_k
+        scores, order = scores.topk(k, 0)
+        bboxes = bboxes[order]
+        areas = areas[order]
+
+        # Computing the iou matrix is memory bound, so we can use half precision on the GPU.
+        # IOU is scale invariant, so we can normalize the coordinates to make sure the areas do not overflow.
+        if self.half and bboxes.is_cuda:
+            norm = bboxes.abs().max().clamp(min=1)
+            bboxes = (bboxes / norm).half()
+            areas = (areas / norm**2).half()
+
+        # Compute iou between each pair of boxes
+        ious = _pairwise_iou(bboxes, areas, bboxes, areas).triu(1)
+
+        # Only boxes of the same class can suppress eachother
+        if self.class_nms:
+            classes = classes[order]
+            same_class = (classes.unsqueeze(0) == classes.unsqueeze(1))
+            ious = ious * same_class.type_as(ious)
 
-        # Compute dx and dy between each pair of boxes (these mat contain every pair twice...)
-        dx = (x2.min(x2.t()) - x1.max(x1.t())).clamp(min=0)
-        dy = (y2.min(y2.t()) - y1.max(y1.t())).clamp(min=0)
+        # Keep boxes that are not suppressed by any box with a higher score
+        keep = ious.max(0)[0] <= self.nms_thresh
+        return torch.zeros_like(boxes[:, 0], dtype=keep.dtype).scatter(0, order, keep)
 
-        # Compute iou
-        intersections = dx * dy
-        areas = (x2 - x1) * (y2 - y1)
-        unions = (areas + areas.t()) - intersections
-        ious = intersections / unions
 
-        # Filter based on iou (and class)
-        conflicting = (ious > self.nms_thresh).triu(1)
+def _pairwise_iou(boxes1, areas1, boxes2, areas2):
+    """ Compute IOU between all boxes from ``boxes1`` with all boxes from ``boxes2``.
 
-        if self.class_nms:
-            classes = classes[order]
-            same_class = (classes.unsqueeze(0) == classes.unsqueeze(1))
-            conflicting = (conflicting & same_class)
+    Args:
+        boxes1 (torch.Tensor): List of bounding boxes
+        areas1 (torch.Tensor): Areas of the bounding boxes in ``boxes1``
+        boxes2 (torch.Tensor): List of bounding boxes
+        areas2 (torch.Tensor): Areas of the bounding boxes in ``boxes2``
 
-        conflicting = conflicting.cpu()
-        if torchversion >= version120:
-            keep = torch.zeros(len(conflicting), dtype=torch.bool)
-        else:
-            keep = torch.zeros(len(conflicting), dtype=torch.uint8)
-        supress = torch.zeros(len(conflicting), dtype=torch.float)
-        for i, row in enumerate(conflicting):
-            if not supress[i]:
-                keep[i] = 1
-                supress[row] = 1
+    Returns:
+        torch.Tensor[len(boxes1) X len(boxes2)]: IOU values
+
+    Note:
+        Tensor format: [[x_top_left, y_top_left, x_bottom_right, y_bottom_right],...]
+    """
+    tl = torch.max(boxes1[:, None, :2], boxes2[:, :2])
+    br = torch.min(boxes1[:, None, 2:], boxes2[:, 2:])
+    intersections = (br - tl).clamp(min=0).prod(2)
+    unions = (areas1[:, None] + areas2) - intersections
 
-        keep = keep.to(boxes.device)
-        return keep.scatter(0, order, keep)
+    return intersections / unions
 
 
 def NonMaxSupression(*args, **kwargs):
@@ -289,7 +417,7 @@ class ReverseLetterbox(BaseTransform):
         - dict-like : This is similar to the callable, but instead of calling the argument, it will use dictionary accessing (self.image_size[img_name])
 
         Note that if your dimensions are the same for all images, it is faster to pass a tuple,
-        as the transformation will be applied to the entire dataframe at once as opposed to grouping it per image and applying the tranform to each group individually.
+        as the scale and padding will be computed once for the entire dataframe as opposed to once for every image.
 
     Note:
         This transform works on a brambox detection dataframe,
@@ -301,30 +429,30 @@ class ReverseLetterbox(BaseTransform):
 
     def __call__(self, boxes):
         if isinstance(self.image_size, (list, tuple)):
-            net_w, net_h = self.network_size[:2]
-            im_w, im_h = self.image_size[:2]
+            scale, pad_x, pad_y = self._get_scale_pad(*self.image_size[:2])
+            return self._transform(boxes.copy(), scale, (pad_x, pad_y))
 
-            # Get scale and pad
-            if im_w == net_w and im_h == net_h:
-                scale = 1
-            elif im_w / net_w >= im_h / net_h:
-                scale = im_w/net_w
-            else:
-                scale = im_h/net_h
-            pad = int((net_w - im_w/scale) / 2), int((net_h - im_h/scale) / 2)
+        if len(boxes) == 0:
+            return boxes.copy()
 
-            return self._transform(boxes.copy(), scale, pad)
+        # Compute scale and pad once per image and transform all boxes at once
+        codes, images = pd.factorize(boxes.image)
+        params = np.array([self._get_scale_pad(*self._get_image_size(img)) for img in images])
+        params = params[codes]
 
-        return boxes.groupby('image').apply(self._apply_transform)
+        return self._transform(boxes.copy(), params[:, 0], (params[:, 1], params[:, 2]))
 
-    def _apply_transform(self, boxes):
-        net_w, net_h = self.network_size[:2]
+    def _get_image_size(self, image):
         if callable(self.image_size):
-            im_w, im_h = self.image_size(boxes.name)
+            im_w, im_h = self.image_size(image)
         else:
-            im_w, im_h = self.image_size[boxes.name]
+            im_w, im_h = self.image_size[image]
+
+        return im_w, im_h
+
+    def _get_scale_pad(self, im_w, im_h):
+        net_w, net_h = self.network_size[:2]
 
-        # Get scale and pad
         if im_w == net_w and im_h == net_h:
             scale = 1
         elif im_w / net_w >= im_h / net_h:
@@ -333,8 +461,7 @@ class ReverseLetterbox(BaseTransform):
             scale = im_h/net_h
         pad = int((net_w - im_w/scale) / 2), int((net_h - im_h/scale) / 2)
 
-        # Transform boxes
-        return self._transform(boxes.copy(), scale, pad)
+        return scale, pad[0], pad[1]
 
     @staticmethod
     def _transform(boxes, scale, pad):
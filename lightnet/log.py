@@ -41,14 +41,13 @@ class ColoredFormatter(logging.Formatter):
             'INFO': ColorCode.WHITE,
             'DEBUG': ColorCode.GRAY,
         }
+        self._build_levelnames()
 
     def format(self, record):
         record = copy.copy(record)
         levelname = record.levelname
-        name = record.name
-        if self.color:
-            color = self.color_codes[levelname] if levelname in self.color_codes else ''
-            record.levelname = f'{ColorCode.BOLD.value}{color.value}{levelname:10}{ColorCode.RESET.value}'
+        if levelname in self.levelnames:
+            record.levelname = self.levelnames[levelname]
         else:
             record.levelname = f'{levelname:10}'
         return logging.Formatter.format(self, record)
@@ -56,6 +55,17 @@ class ColoredFormatter(logging.Formatter):
     def setColor(self, value):
         """ Enable or disable colored output for this handler """
         self.color = value
+        self._build_levelnames()
+
+    def _build_levelnames(self):
+        """ Precompute the (colored) level names, so they do not need to be formatted for every record """
+        if self.color:
+            self.levelnames = {
+                levelname: f'{ColorCode.BOLD.value}{color.value}{levelname:10}{ColorCode.RESET.value}'
+                for levelname, color in self.color_codes.items()
+            }
+        else:
+            self.levelnames = {levelname: f'{levelname:10}' for levelname in self.color_codes}
 
 
 # Filter
@@ -84,6 +84,10 @@ class Darknet(Lightnet):
             except NotImplementedError:
                 log.debug(f'Layer skipped: {module.__class__.__name__}')
 
+        # Wait for asynchronous copies to CUDA tensors
+        if weights.async_copies:
+            torch.cuda.synchronize()
+
     def _save_darknet_weights(self, weights_file):
         weights = WeightSaver(self.header, 0)
 
@@ -115,63 +119,51 @@ class WeightLoader:
                 log.error('New weight file syntax! Loading of weights might not work properly. Please submit an issue with the weight file version number. [Run with DEBUG logging level]')
                 self.seen = int(np.fromfile(fp, count=1, dtype=np.int64)[0])
 
-            self.buf = np.fromfile(fp, dtype=np.float32)
+            offset = fp.tell()
+
+        # Memory map the weights, so they only get read from disk when they are loaded into a layer (copy-on-write, as torch needs writeable arrays)
+        self.buf = np.memmap(filename, dtype=np.float32, mode='c', offset=offset)
 
         self.start = 0
         self.size = self.buf.size
+        self.async_copies = False
+        self.dispatch = {
+            nn.Conv2d: self._load_conv,
+            Conv2dBatchReLU: self._load_convbatch,
+            nn.Linear: self._load_fc,
+        }
 
     def load_layer(self, layer):
         """ Load weights for a layer from the weights file """
-        if type(layer) == nn.Conv2d:
-            self._load_conv(layer)
-        elif type(layer) == Conv2dBatchReLU:
-            self._load_convbatch(layer)
-        elif type(layer) == nn.Linear:
-            self._load_fc(layer)
-        else:
-            raise NotImplementedError(f'The layer you are trying to load is not supported [{type(layer)}]')
+        _dispatch(self.dispatch, layer, 'load')(layer)
 
     def _load_conv(self, model):
-        num_b = model.bias.numel()
-        model.bias.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                   .view_as(model.bias.data))
-        self.start += num_b
-
-        num_w = model.weight.numel()
-        model.weight.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_w])
-                                     .view_as(model.weight.data))
-        self.start += num_w
+        self._load_tensor(model.bias.data)
+        self._load_tensor(model.weight.data)
 
     def _load_convbatch(self, model):
-        num_b = model.layers[1].bias.numel()
-        model.layers[1].bias.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                             .view_as(model.layers[1].bias.data))
-        self.start += num_b
-        model.layers[1].weight.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                               .view_as(model.layers[1].weight.data))
-        self.start += num_b
-        model.layers[1].running_mean.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                                .view_as(model.layers[1].running_mean))
-        self.start += num_b
-        model.layers[1].running_var.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                               .view_as(model.layers[1].running_var))
-        self.start += num_b
-
-        num_w = model.layers[0].weight.numel()
-        model.layers[0].weight.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_w])
-                                               .view_as(model.layers[0].weight.data))
-        self.start += num_w
+        self._load_tensor(model.layers[1].bias.data)
+        self._load_tensor(model.layers[1].weight.data)
+        self._load_tensor(model.layers[1].running_mean)
+        self._load_tensor(model.layers[1].running_var)
+        self._load_tensor(model.layers[0].weight.data)
 
     def _load_fc(self, model):
-        num_b = model.bias.numel()
-        model.bias.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                   .view_as(model.bias.data))
-        self.start += num_b
+        self._load_tensor(model.bias.data)
+        self._load_tensor(model.weight.data)
 
-        num_w = model.weight.numel()
-        model.weight.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_w])
-                                     .view_as(model.weight.data))
-        self.start += num_w
+    def _load_tensor(self, tensor):
+        """ Copy the next values of the weight file into a tensor.
+        Values for CUDA tensors are staged in pinned memory, so that the copy can run asynchronously.
+        """
+        num = tensor.numel()
+        src = torch.from_numpy(self.buf[self.start:self.start+num]).view_as(tensor)
+        if tensor.is_cuda:
+            src = src.pin_memory()
+            self.async_copies = True
+
+        tensor.copy_(src, non_blocking=True)
+        self.start += num
 
 
 class WeightSaver:
@@ -188,38 +180,57 @@ class WeightSaver:
             log.error('New weight file syntax! Saving of weights might not work properly. Please submit an issue with the weight file version number. [Run with DEBUG logging level]')
             self.seen = np.int64(seen)
 
+        self.dispatch = {
+            nn.Conv2d: self._save_conv,
+            Conv2dBatchReLU: self._save_convbatch,
+            nn.Linear: self._save_fc,
+        }
+
     def write_file(self, filename):
         """ Save the accumulated weights to a darknet weightfile """
         log.debug(f'Writing weight file: version {self.header[0]}.{self.header[1]}.{self.header[2]}')
         with open(filename, 'wb') as fp:
             self.header.tofile(fp)
             self.seen.tofile(fp)
-            for np_arr in self.weights:
-                np_arr.tofile(fp)
+            if len(self.weights) > 0:
+                weights = torch.cat([tensor.reshape(-1) for tensor in self.weights])
+                weights.cpu().numpy().astype(np.float32, copy=False).tofile(fp)
         log.info(f'Weight file saved as {filename}')
 
     def save_layer(self, layer):
         """ save weights for a layer """
-        if type(layer) == nn.Conv2d:
-            self._save_conv(layer)
-        elif type(layer) == Conv2dBatchReLU:
-            self._save_convbatch(layer)
-        elif type(layer) == nn.Linear:
-            self._save_fc(layer)
-        else:
-            raise NotImplementedError(f'The layer you are trying to save is not supported [{type(layer)}]')
+        _dispatch(self.dispatch, layer, 'save')(layer)
 
     def _save_conv(self, model):
-        self.weights.append(model.bias.cpu().data.numpy())
-        self.weights.append(model.weight.cpu().data.numpy())
+        self._save_tensor(model.bias)
+        self._save_tensor(model.weight)
 
     def _save_convbatch(self, model):
-        self.weights.append(model.layers[1].bias.cpu().data.numpy())
-        self.weights.append(model.layers[1].weight.cpu().data.numpy())
-        self.weights.append(model.layers[1].running_mean.cpu().numpy())
-        self.weights.append(model.layers[1].running_var.cpu().numpy())
-        self.weights.append(model.layers[0].weight.cpu().data.numpy())
+        self._save_tensor(model.layers[1].bias)
+        self._save_tensor(model.layers[1].weight)
+        self._save_tensor(model.layers[1].running_mean)
+        self._save_tensor(model.layers[1].running_var)
+        self._save_tensor(model.layers[0].weight)
 
     def _save_fc(self, model):
-        self.weights.append(model.bias.cpu().data.numpy())
-        self.weights.append(model.weight.cpu().data.numpy())
+        self._save_tensor(model.bias)
+        self._save_tensor(model.weight)
+
+    def _save_tensor(self, tensor):
+        """ Queue a tensor to be saved.
+        The tensors are only transferred to the CPU when writing the file, so that this happens in one single copy.
+        """
+        self.weights.append(tensor.detach())
+
+
+def _dispatch(functions, layer, action):
+    """ Get the function to load/save a layer, by looking up its type or one of its base classes """
+    fn = functions.get(type(layer))
+    if fn is not None:
+        return fn
+
+    for layer_type, fn in functions.items():
+        if isinstance(layer, layer_type):
+            return fn
+
+    raise NotImplementedError(f'The layer you are trying to {action} is not supported [{type(layer)}]')
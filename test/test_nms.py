@@ -0,0 +1,60 @@
+#
+#   Test non-maxima suppression post-processing
+#   Copyright EAVISE
+#
+
+import pytest
+import torch
+import lightnet as ln
+
+nms_classes = ['NonMaxSuppression', 'NonMaxSuppressionFast']
+
+
+@pytest.fixture(scope='module')
+def input_boxes():
+    # batch_num, x_center, y_center, width, height, confidence, class_id
+    return torch.tensor([
+        [0, 0.50, 0.50, 0.20, 0.20, 0.90, 0],
+        [0, 0.51, 0.50, 0.20, 0.20, 0.80, 0],   # Overlaps with box 0
+        [0, 0.51, 0.50, 0.20, 0.20, 0.70, 1],   # Overlaps with box 0, but other class
+        [0, 0.10, 0.10, 0.10, 0.10, 0.60, 0],   # No overlap
+        [1, 0.51, 0.50, 0.20, 0.20, 0.50, 0],   # Overlaps with box 0, but other batch
+    ])
+
+
+@pytest.mark.parametrize('nms', nms_classes)
+def test_nms_cpu(nms, input_boxes):
+    uut = getattr(ln.data.transform, nms)(0.5, class_nms=True)
+    output = uut(input_boxes.clone())
+    assert output.shape == (4, 7)
+    assert torch.equal(output, input_boxes[[0, 2, 3, 4]])
+
+    uut = getattr(ln.data.transform, nms)(0.5, class_nms=False)
+    output = uut(input_boxes.clone())
+    assert output.shape == (3, 7)
+    assert torch.equal(output, input_boxes[[0, 3, 4]])
+
+
+def test_nms_fast_top_k(input_boxes):
+    uut = ln.data.transform.NonMaxSuppressionFast(0.5, class_nms=True, top_k=3)
+    output = uut(input_boxes.clone())
+    assert output.shape == (3, 7)
+    assert torch.equal(output, input_boxes[[0, 2, 4]])
+
+
+@pytest.mark.parametrize('nms', nms_classes)
+def test_nms_empty(nms):
+    uut = getattr(ln.data.transform, nms)(0.5)
+    output = uut(torch.tensor([]))
+    assert output.numel() == 0
+
+
+@pytest.mark.parametrize('nms', nms_classes)
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA not available')
+def test_nms_cuda(nms, input_boxes):
+    input_boxes = input_boxes.to('cuda')
+
+    uut = getattr(ln.data.transform, nms)(0.5, class_nms=True)
+    output = uut(input_boxes.clone())
+    assert output.shape == (4, 7)
+    assert torch.equal(output, input_boxes[[0, 2, 3, 4]])